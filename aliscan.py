@@ -4,27 +4,141 @@
 # author email: patrick.demarta@gmail.com
 
 import csv
+import gzip
+import hashlib
+import io
+import json
 import sys
 import os
+import tempfile
+from collections import Counter
 from Bio import SeqIO
 
-def create_state():
-    """Create an initial state dictionary with default values"""
-    return {
-        "alignment": [],
-        "num_of_seqs": 0,
-        "seq_size": 0,
-        "groups": [],
-        "ka": 20,
-        "kb": 20,
-        "scoring_formula": "1 - (ka*0.5)*(1-a) - (kb*0.1)*b",
-        "score_color_ranges": [0.5, 0.7, 0.8, 0.9],
-        "paging_window_lenght": 120,  # Changed from 80 to 120 bases per line
-        "label_size": 20,
-        "scores": [],
-        "input_filename": "",
-        "output_mode": "html"  # Can be 'html' or 'text'
+# Symbols tracked by the alignment index, anything else counts as unknown
+INDEX_SYMBOLS = ("A", "C", "T", "G", "-")
+
+# Frequency keys and the symbol they stand for in a group consensus
+FREQUENCY_SYMBOLS = (("fA", "A"), ("fC", "C"), ("fT", "T"), ("fG", "G"), ("fgap", "-"), ("fN", "N"))
+
+# Score percentiles reported for each group in the summary
+SUMMARY_PERCENTILES = (10, 50, 90)
+
+class State:
+    """
+    Immutable scan state, read with dict-style access (state["ka"]).
+    replace() returns a new state sharing every unchanged field by reference,
+    derived data (alignment index and hash, group pairs) is computed
+    lazily and dropped only when one of the fields it depends on changes
+    """
+    FIELDS = ("alignment", "num_of_seqs", "seq_size", "groups", "ka", "kb",
+              "scoring_formula", "score_color_ranges", "paging_window_lenght",
+              "label_size", "scores", "input_filename", "output_mode", "summary")
+    
+    # Derived data and the fields it depends on
+    DERIVED = {
+        "index": ("alignment", "seq_size"),
+        "alignment_hash": ("alignment",),
+        "group_pairs": ("groups",)
     }
+    
+    __slots__ = FIELDS + ("derived",)
+    
+    def __init__(self, derived=None, **fields):
+        values = {
+            "alignment": [],
+            "num_of_seqs": 0,
+            "seq_size": 0,
+            "groups": [],
+            "ka": 20,
+            "kb": 20,
+            "scoring_formula": "1 - (ka*0.5)*(1-a) - (kb*0.1)*b",
+            "score_color_ranges": [0.5, 0.7, 0.8, 0.9],
+            "paging_window_lenght": 120,  # Changed from 80 to 120 bases per line
+            "label_size": 20,
+            "scores": [],
+            "input_filename": "",
+            "output_mode": "html",  # Can be 'html' or 'text'
+            "summary": None  # Per-group report, set by scan(state, summary=True)
+        }
+        for name in fields:
+            if name not in values:
+                raise KeyError(f"Unknown state field: {name}")
+        values.update(fields)
+        for name in self.FIELDS:
+            object.__setattr__(self, name, values[name])
+        object.__setattr__(self, "derived", dict(derived or {}))
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("State is immutable, use replace() or the set_* functions")
+    
+    def __getitem__(self, key):
+        if key in self.DERIVED:
+            if key not in self.derived:
+                self.derived[key] = self.compute(key)
+            return self.derived[key]
+        if key in self.FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+    
+    def __contains__(self, key):
+        return key in self.FIELDS or key in self.DERIVED
+    
+    def __iter__(self):
+        return iter(self.FIELDS)
+    
+    def __getstate__(self):
+        fields = {name: getattr(self, name) for name in self.FIELDS}
+        derived = dict(self.derived)
+        return fields, derived
+    
+    def __setstate__(self, pickled):
+        # Fields added since the state was pickled take their defaults,
+        # fields and derived data that no longer exist are dropped
+        fields, derived = pickled
+        derived = {key: value for key, value in derived.items() if key in self.DERIVED}
+        self.__init__(derived, **{name: value for name, value in fields.items() if name in self.FIELDS})
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        return self.FIELDS
+    
+    def copy(self):
+        """States are immutable, a copy is the state itself"""
+        return self
+    
+    def replace(self, **changes):
+        """Return a new state with changed fields, keeping the derived data they don't invalidate"""
+        fields = {name: getattr(self, name) for name in self.FIELDS}
+        fields.update(changes)
+        derived = {key: value for key, value in self.derived.items()
+                   if not any(name in changes for name in self.DERIVED[key])}
+        return State(derived, **fields)
+    
+    def compute(self, key):
+        """Compute the derived data key"""
+        if key == "index":
+            return build_index(self.alignment, self.seq_size)
+        if key == "alignment_hash":
+            return alignment_hash(self.alignment)
+        if key == "group_pairs":
+            return build_group_pairs(self.groups)
+
+def create_state():
+    """Create an initial state with default values"""
+    return State()
+
+def to_state(state):
+    """Return state as a State, converting the dictionaries used by older versions"""
+    if isinstance(state, State):
+        return state
+    fields = {name: state[name] for name in State.FIELDS if name in state}
+    derived = {key: state[key] for key in ("index", "alignment_hash") if state.get(key)}
+    return State(derived, **fields)
 
 def load_alignment(state, infile, *group_defs):
     """
@@ -32,14 +146,18 @@ def load_alignment(state, infile, *group_defs):
     Required: fasta format multiple sequence alignment filename  
     Optional: groups definition as comma separated list of arrays and/or ranges
     """
-    state = state.copy()
+    alignment = create_alignment(infile)
+    state = to_state(state).replace(
+        input_filename=infile,
+        alignment=alignment,
+        num_of_seqs=len(alignment),
+        seq_size=len(alignment[0].seq),
+        groups=sanitize(alignment, group_defs),
+        scores=[]
+    )
     
-    state["input_filename"] = infile
-    state["alignment"] = create_alignment(infile)
-    state["num_of_seqs"] = len(state["alignment"])
-    state["seq_size"] = len(state["alignment"][0].seq)
-    state["groups"] = sanitize(state["alignment"], group_defs)
-    state["scores"] = []
+    # Build the alignment index once, at load time
+    state["index"]
     
     return state
 
@@ -51,6 +169,66 @@ def create_alignment(filename):
             alignment_data.append(record)
     return alignment_data
 
+def build_index(alignment_data, seq_size):
+    """
+    Build the per-column summary index of an alignment:
+    "rows" holds each sequence as an uppercase string padded with N to seq_size,
+    "columns" maps each symbol to a list of per-column bitsets, where bit seq_id
+    is set when that sequence has the symbol at that column
+    """
+    rows = []
+    for record in alignment_data:
+        rows.append(str(record.seq).upper()[:seq_size].ljust(seq_size, "N"))
+    
+    columns = {symbol: [] for symbol in INDEX_SYMBOLS}
+    for column in zip(*rows):
+        # Reverse the column so that sequence 0 ends up in the lowest bit
+        column = "".join(reversed(column))
+        for symbol in INDEX_SYMBOLS:
+            bits = "".join("1" if base == symbol else "0" for base in column)
+            columns[symbol].append(int(bits, 2) if bits else 0)
+    
+    return {"rows": rows, "columns": columns}
+
+def alignment_hash(alignment_data):
+    """Return a sha256 hex digest of the sequences' descriptions and bases"""
+    digest = hashlib.sha256()
+    for record in alignment_data:
+        digest.update(record.description.encode("utf-8") + b"\n")
+        digest.update(str(record.seq).encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+def results_key(state):
+    """
+    Return a hex digest identifying the scan results of a state:
+    alignment and its input filename (shown in the HTML), groups, ka, kb,
+    scoring formula and the HTML display settings
+    """
+    params = [
+        to_state(state)["alignment_hash"],
+        state["input_filename"],
+        state["groups"],
+        float(state["ka"]),
+        float(state["kb"]),
+        state["scoring_formula"],
+        state["score_color_ranges"],
+        state["paging_window_lenght"],
+        state["label_size"]
+    ]
+    return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()
+
+def group_mask(group):
+    """
+    Return the bitset of a group of sequence indexes,
+    None if the group can't be represented as a bitset (repeated or negative indexes)
+    """
+    if len(set(group)) != len(group) or any(seq_id < 0 for seq_id in group):
+        return None
+    mask = 0
+    for seq_id in group:
+        mask |= 1 << seq_id
+    return mask
+
 def sanitize(alignment_data, groups_def):
     """
     Generate a list of sequence-indexes' lists,
@@ -68,47 +246,140 @@ def sanitize(alignment_data, groups_def):
                 sanitized_groups.append(list(group))
     return sanitized_groups
 
-def scan(state):
+def scan(state, summary=False):
     """
     Iterate along nt positions, calculate nt frequencies for ingroup and outgroups, calculate nt score
+    Optional: summary=True also sets state["summary"], the per-group report built by summarize_position,
+    otherwise state["summary"] is reset as it would describe other scores
     """
-    state = state.copy()
-    
-    # Create a copy of groups to avoid modifying original
-    groups_copy = [group.copy() for group in state["groups"]]
+    state = to_state(state)
     
     # Ensure there are valid groups
-    if not groups_copy or all(len(group) == 0 for group in groups_copy):
+    if not state["groups"] or all(len(group) == 0 for group in state["groups"]):
         print("Warning: No valid sequence groups defined")
         return state
     
-    state["scores"] = reset_scores(state)
-    sequence_length_range = range(state["seq_size"])
+    scores = reset_scores(state)
+    formula = compile_formula(state["scoring_formula"])
+    group_pairs = state["group_pairs"]
     
-    for position in sequence_length_range:
-        for _ in range(len(groups_copy)):
-            ingroup = groups_copy.pop(0)
-            outgroup = []
-            for group in groups_copy:
-                outgroup.extend(group)
-            groups_copy.append(ingroup)
-            
-            # Skip calculations if ingroup is empty
-            if not ingroup:
-                continue
-                
-            ingroup_frequencies = calculate_nt_freq(state, ingroup, position)
-            outgroup_frequencies = calculate_nt_freq(state, outgroup, position)
-            state = calculate_score(state, ingroup, position, ingroup_frequencies, outgroup_frequencies)
+    report = None
+    if summary:
+        group_indexes = [group_index for group_index, group in enumerate(state["groups"]) if group]
+        report = [new_group_summary(group_index, state["groups"][group_index]) for group_index in group_indexes]
     
-    return state
+    for position in range(state["seq_size"]):
+        for pair_index, (ingroup, outgroup, ingroup_mask, outgroup_mask) in enumerate(group_pairs):
+            ingroup_frequencies = calculate_nt_freq(state, ingroup, position, ingroup_mask)
+            outgroup_frequencies = calculate_nt_freq(state, outgroup, position, outgroup_mask)
+            score_position(state, ingroup, position, ingroup_frequencies, outgroup_frequencies, scores, formula)
+            if report is not None:
+                summarize_position(report[pair_index], outgroup, position, ingroup_frequencies, outgroup_frequencies)
+    
+    if report is None:
+        return state.replace(scores=scores, summary=None)
+    
+    occurrences = [Counter(ingroup) for ingroup, _, _, _ in group_pairs]
+    return state.replace(scores=scores, summary={
+        "ka": state["ka"],
+        "kb": state["kb"],
+        "scoring_formula": state["scoring_formula"],
+        "groups": [finish_group_summary(group_summary, group_scores(occurrences, pair_index, scores))
+                   for pair_index, group_summary in enumerate(report)]
+    })
+
+def new_group_summary(group_index, group):
+    """Create the empty summary of a group, filled by summarize_position"""
+    return {
+        "group": group_index,
+        "sequences": list(group),
+        "consensus": [],
+        "diagnostic_positions": []
+    }
+
+def summarize_position(group_summary, outgroup, position, ingroup_frequencies, outgroup_frequencies):
+    """
+    Add a scanned position to a group summary: the most frequent ingroup symbol to the consensus,
+    and the position to the diagnostic ones if the ingroup is fully conserved on a symbol absent
+    from a non empty outgroup
+    """
+    consensus_key, consensus_symbol = max(FREQUENCY_SYMBOLS, key=lambda item: ingroup_frequencies[item[0]])
+    group_summary["consensus"].append(consensus_symbol)
+    
+    # Without an outgroup its frequencies are all zero, nothing can be diagnostic
+    if (outgroup and consensus_symbol != "N" and ingroup_frequencies[consensus_key] == 1
+            and outgroup_frequencies[consensus_key] == 0):
+        # 1-based, as in the HTML ruler
+        group_summary["diagnostic_positions"].append(position + 1)
+
+def group_scores(occurrences, pair_index, scores):
+    """
+    Return the scores of the ingroup of a group pair, read from the scanned scores.
+    At each position scan appends one score per occurrence of a sequence in each ingroup,
+    in pair order: occurrences holds the Counter of sequence indexes of each pair's ingroup
+    """
+    values = []
+    seen = Counter()
+    for seq_id in occurrences[pair_index].elements():
+        total = sum(counter[seq_id] for counter in occurrences)
+        offset = sum(counter[seq_id] for counter in occurrences[:pair_index]) + seen[seq_id]
+        seen[seq_id] += 1
+        values.extend(scores[seq_id][offset::total])
+    return values
+
+def finish_group_summary(group_summary, scores):
+    """Turn the collected consensus symbols and the scores of a group into the reported values"""
+    group_scores = sorted(scores)
+    finished = {
+        "group": group_summary["group"],
+        "sequences": group_summary["sequences"],
+        "consensus": "".join(group_summary["consensus"]),
+        "diagnostic_positions": group_summary["diagnostic_positions"],
+        "score_mean": sum(group_scores) / len(group_scores) if group_scores else None
+    }
+    for pct in SUMMARY_PERCENTILES:
+        finished[f"score_p{pct}"] = percentile(group_scores, pct)
+    return finished
+
+def percentile(sorted_values, pct):
+    """Return the pct percentile of sorted values with linear interpolation, None if there are no values"""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+def build_group_pairs(groups):
+    """
+    Build the (ingroup, outgroup, ingroup_mask, outgroup_mask) pair of each non empty group,
+    the outgroup being all the other groups
+    """
+    # Create a copy of groups to avoid modifying original
+    groups_copy = [list(group) for group in groups]
+    
+    group_pairs = []
+    for _ in range(len(groups_copy)):
+        ingroup = groups_copy.pop(0)
+        outgroup = []
+        for group in groups_copy:
+            outgroup.extend(group)
+        groups_copy.append(ingroup)
+        
+        # Skip calculations if ingroup is empty
+        if ingroup:
+            group_pairs.append((ingroup, outgroup, group_mask(ingroup), group_mask(outgroup)))
+    return group_pairs
 
 def reset_scores(state):
     """Create a new scores list of num_of_seqs empty lists"""
     return [[] for _ in range(state["num_of_seqs"])]
 
-def calculate_nt_freq(state, group, position):
-    """Calculate (a,c,t,g,-,n) frequencies at current position in group"""
+def calculate_nt_freq(state, group, position, mask=None):
+    """
+    Calculate (a,c,t,g,-,n) frequencies at current position in group,
+    counts come from the alignment index when the group bitset mask is given
+    """
     num_of_seqs_in_group = len(group)
     # Return default frequencies if group is empty to avoid division by zero
     if num_of_seqs_in_group == 0:
@@ -121,6 +392,23 @@ def calculate_nt_freq(state, group, position):
             "fN": 0    # Add unknown base frequency
         }
     
+    if mask is not None and state.get("index"):
+        columns = state["index"]["columns"]
+        a = popcount(columns["A"][position] & mask)
+        c = popcount(columns["C"][position] & mask)
+        t = popcount(columns["T"][position] & mask)
+        g = popcount(columns["G"][position] & mask)
+        gap = popcount(columns["-"][position] & mask)
+        unknown = num_of_seqs_in_group - (a + c + t + g + gap)
+        return {
+            "fA": a / num_of_seqs_in_group,
+            "fT": t / num_of_seqs_in_group,
+            "fC": c / num_of_seqs_in_group,
+            "fG": g / num_of_seqs_in_group,
+            "fgap": gap / num_of_seqs_in_group,
+            "fN": unknown / num_of_seqs_in_group
+        }
+    
     a = c = t = g = gap = unknown = 0
     
     for seq_id in group:
@@ -148,13 +436,42 @@ def calculate_nt_freq(state, group, position):
         "fN": unknown / num_of_seqs_in_group
     }
 
+def popcount(bits):
+    """Count the set bits of a bitset"""
+    return bin(bits).count("1")
+
 def calculate_score(state, ingroup, position, ingroup_frequencies, outgroup_frequencies):
     """
     Set the current base frequencies values on a (consensus) and b (aspecificity)
     evaluate the scoring formula and stores the score
     """
-    state = state.copy()
-    scores_copy = [score.copy() for score in state["scores"]]
+    state = to_state(state)
+    # Copy only the score lists of the ingroup, the others are shared with state
+    scores = list(state["scores"])
+    for seq_id in ingroup:
+        scores[seq_id] = list(scores[seq_id])
+    
+    score_position(state, ingroup, position, ingroup_frequencies, outgroup_frequencies, scores)
+    return state.replace(scores=scores)
+
+def compile_formula(formula):
+    """
+    Compile the scoring formula once for a whole scan,
+    an invalid formula is returned as is to be reported by eval on each base
+    """
+    try:
+        return compile(formula, "<scoring_formula>", "eval")
+    except SyntaxError:
+        return formula
+
+def score_position(state, ingroup, position, ingroup_frequencies, outgroup_frequencies, scores, formula=None):
+    """
+    Append the score at position of each ingroup sequence to its list in scores,
+    the formula is evaluated once per base symbol
+    """
+    if formula is None:
+        formula = compile_formula(state["scoring_formula"])
+    symbol_scores = {}
     
     for seq_id in ingroup:
         base_val = get_base(state, seq_id, position)
@@ -162,7 +479,11 @@ def calculate_score(state, ingroup, position, ingroup_frequencies, outgroup_freq
         
         # Handle unknown bases by assigning zero score immediately
         if base_val not in "ACGT-":
-            scores_copy[seq_id].append(0)
+            scores[seq_id].append(0)
+            continue
+        
+        if base_val in symbol_scores:
+            scores[seq_id].append(symbol_scores[base_val])
             continue
         
         if base_val == "A":
@@ -187,7 +508,7 @@ def calculate_score(state, ingroup, position, ingroup_frequencies, outgroup_freq
         
         try:
             # Evaluate the scoring formula with safety check
-            score = eval(state["scoring_formula"])
+            score = eval(formula, globals(), {"a": a, "b": b, "ka": ka, "kb": kb})
         except ZeroDivisionError:
             # Handle division by zero cases
             score = 0
@@ -196,10 +517,8 @@ def calculate_score(state, ingroup, position, ingroup_frequencies, outgroup_freq
             print(f"Formula evaluation error: {e}")
             score = 0
         
-        scores_copy[seq_id].append(score)
-    
-    state["scores"] = scores_copy
-    return state
+        symbol_scores[base_val] = score
+        scores[seq_id].append(score)
 
 def color_mask_score(state, base, nt_score):
     """Color masking according to the base score using HTML styling"""
@@ -344,6 +663,9 @@ def paging(state):
 
 def get_base(state, seq_id, position):
     """Return the uppercase base given seq_id and position"""
+    index = state.get("index")
+    if index and 0 <= seq_id < len(index["rows"]) and 0 <= position < state["seq_size"]:
+        return index["rows"][seq_id][position]
     try:
         return str(state["alignment"][seq_id].seq[position]).upper()
     except (IndexError, AttributeError):
@@ -359,47 +681,87 @@ def scores2csv(state, outfile):
             writer.writerow([definition] + seq_score)
 
 
+def summary_to_json(summary):
+    """Convert a scan summary to a JSON document"""
+    return json.dumps(summary, indent=2)
+
+def summary_to_csv(summary):
+    """Convert a scan summary to CSV, one row per group"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["group", "num_of_seqs", "score_mean"]
+                    + [f"score_p{pct}" for pct in SUMMARY_PERCENTILES]
+                    + ["num_of_diagnostic_positions", "diagnostic_positions", "consensus"])
+    for group_summary in summary["groups"]:
+        writer.writerow([group_summary["group"], len(group_summary["sequences"]), group_summary["score_mean"]]
+                        + [group_summary[f"score_p{pct}"] for pct in SUMMARY_PERCENTILES]
+                        + [len(group_summary["diagnostic_positions"]),
+                           " ".join(str(position) for position in group_summary["diagnostic_positions"]),
+                           group_summary["consensus"]])
+    return output.getvalue()
+
+def summary2json(state, outfile):
+    """Write the scan summary in a json outfile"""
+    write_atomic(outfile, summary_to_json(state["summary"]))
+
+def summary2csv(state, outfile):
+    """Write the scan summary in a csv outfile"""
+    write_atomic(outfile, summary_to_csv(state["summary"]))
+
 def set_ka(state, value):
     """Set the ka parameter (consensus coefficient)"""
-    state = state.copy()
-    state["ka"] = value
-    return state
+    return to_state(state).replace(ka=value)
     
 def set_kb(state, value):
     """Set the kb parameter (aspecificity tolerance coefficient)"""
-    state = state.copy()
-    state["kb"] = value
-    return state
+    return to_state(state).replace(kb=value)
 
 def set_groups(state, group_list):
     """Set the groups of sequences"""
-    state = state.copy()
-    state["groups"] = group_list  # Simply assign the group_list directly
-    return state
+    return to_state(state).replace(groups=group_list)  # Simply assign the group_list directly
     
 def set_scoring_formula(state, formula):
     """Set the scoring formula"""
-    state = state.copy()
-    state["scoring_formula"] = formula
-    return state
+    return to_state(state).replace(scoring_formula=formula)
     
 def set_color_ranges(state, ranges):
     """Set the color ranges for scoring"""
-    state = state.copy()
+    state = to_state(state)
     if len(ranges) == 4:
-        state["score_color_ranges"] = list(ranges)
+        state = state.replace(score_color_ranges=list(ranges))
     return state
 
 def scores2html(state, outfile="alignment.html"):
-    """Write the HTML color-masked alignment to a file"""
+    """Write the HTML color-masked alignment to a file, gzip compressed if outfile ends with .gz"""
     html_content = scores_to_html(state)
-    
-    with open(outfile, "w", encoding="utf-8") as f:
-        f.write(html_content)
+    if outfile.endswith(".gz"):
+        # mtime=0 keeps the compressed bytes identical for identical results
+        write_atomic(outfile, gzip.compress(html_content.encode("utf-8"), mtime=0))
+    else:
+        write_atomic(outfile, html_content)
     
     print(f"HTML output written to '{outfile}'")
     return outfile
 
+def write_atomic(outfile, content):
+    """
+    Write text or bytes content to outfile through a temporary file in the same directory,
+    readers never see a partially written file
+    """
+    out_dir = os.path.dirname(os.path.abspath(outfile))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix=".tmp_", suffix=os.path.basename(outfile))
+    try:
+        if isinstance(content, bytes):
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+        else:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+        os.replace(tmp_path, outfile)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
 # Example of how to use the functions:
 def run_example(fasta_file, outfile="results.html"):
     """Example of how to use this module with HTML output"""
@@ -2,60 +2,149 @@
 # Web interface for aliscan
 # author email: patrick.demarta@gmail.com
 
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, session
+from flask import Blueprint, Flask, current_app, make_response, render_template, request, redirect, url_for, flash, send_file, session
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import gzip
+import io
+import json
 import os
 import tempfile
 import uuid
 import re
 from werkzeug.utils import secure_filename
 import aliscan
-from db import init_db, store_state, get_state, get_alignment_file, delete_session
+from db import init_db, store_state, get_state, get_alignment_file, delete_session, start_scan, finish_scan, is_current_scan, get_scan, delete_scan
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'alignment_scanner_secret_key'
-app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
-app.config['SESSION_COOKIE_HTTPONLY'] = True
+DEFAULT_SECRET_KEY = 'alignment_scanner_secret_key'
 
-# Ensure upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+bp = Blueprint('aliscan', __name__)
 
-# Initialize the database
-init_db()
+def create_app(test_config=None):
+    """
+    Create and configure the aliscan Flask application.
+    Configuration defaults can be overridden by ALISCAN_* environment variables
+    (e.g. ALISCAN_SECRET_KEY, ALISCAN_UPLOAD_FOLDER, ALISCAN_DATABASE, ALISCAN_SCAN_WORKERS)
+    and then by test_config.
+    """
+    app = Flask(__name__)
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    app.config.from_mapping(
+        SECRET_KEY=DEFAULT_SECRET_KEY,
+        UPLOAD_FOLDER=os.path.join(base_dir, 'uploads'),
+        DATABASE=os.path.join(base_dir, 'aliscan.db'),
+        MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16MB max upload size
+        SESSION_COOKIE_HTTPONLY=True,
+        SCAN_WORKERS=2,     # Background scan threads per process, 0 runs scans inline
+        SCAN_TIMEOUT=600,   # Seconds after which a running scan is considered lost
+    )
+    app.config.from_prefixed_env('ALISCAN')
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    
+    # Ensure upload folder exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    
+    # Initialize the database
+    init_db(app.config['DATABASE'])
+    
+    # Threads are only started on the first submitted scan, so the executor is
+    # safe to create before a pre-forking server (gunicorn --preload) forks workers
+    workers = int(app.config['SCAN_WORKERS'])
+    app.extensions['aliscan_executor'] = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+    
+    app.register_blueprint(bp)
+    return app
 
-@app.before_request
+@bp.before_app_request
 def create_session():
     """Ensure each user has a session."""
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
 
-@app.route('/', methods=['GET'])
+def database():
+    """Path of the database of the current application."""
+    return current_app.config['DATABASE']
+
+def results_path(result_key, upload_folder=None):
+    """
+    Path of the gzip compressed results file of a scan, named after its results key
+    (see aliscan.results_key). The key covers the session's own upload path, so each
+    session has its own artifacts, pruned when it moves to a new key.
+    """
+    return os.path.join(upload_folder or current_app.config['UPLOAD_FOLDER'], f'results_{result_key}.html.gz')
+
+def summary_path(result_key, upload_folder=None):
+    """Path of the JSON group summary of a scan, named after its results key."""
+    return os.path.join(upload_folder or current_app.config['UPLOAD_FOLDER'], f'summary_{result_key}.json')
+
+def prune_results(upload_folder, result_key):
+    """Delete the results and summary artifacts of a results key."""
+    for path in (results_path(result_key, upload_folder), summary_path(result_key, upload_folder)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def read_summary(result_key):
+    """Return the group summary of a scan, or None if there is none."""
+    if not result_key or not os.path.exists(summary_path(result_key)):
+        return None
+    with open(summary_path(result_key), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def read_results(result_key):
+    """Return the decompressed HTML results of a scan, or an empty string if there are none."""
+    if not result_key or not os.path.exists(results_path(result_key)):
+        return ''
+    with gzip.open(results_path(result_key), 'rt', encoding='utf-8') as f:
+        return f.read()
+
+def save_upload_atomic(file, file_path):
+    """Save an uploaded file through a temporary file, so readers never see a partial upload."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix='.tmp_')
+    os.close(fd)
+    try:
+        file.save(tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+@bp.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
+@bp.route('/upload', methods=['POST'])
 def upload_file():
     if 'alignment_file' not in request.files:
         flash('No file part')
         return redirect(request.url)
-        
+    
     file = request.files['alignment_file']
     if file.filename == '':
         flash('No selected file')
         return redirect(request.url)
-        
+    
     if file:
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        # Prefix with the session id, the uploads folder is shared by all sessions
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], f'{session["session_id"]}_{filename}')
+        save_upload_atomic(file, file_path)
         
         try:
             # Initialize state
             state = aliscan.create_state()
             state = aliscan.load_alignment(state, file_path)
             
+            # Drop the scan and results of the previous alignment before storing the new one,
+            # so they are neither served for it nor stored over it by a scan still running
+            previous_result_key = delete_scan(session['session_id'], db_path=database())
+            if previous_result_key:
+                prune_results(current_app.config['UPLOAD_FOLDER'], previous_result_key)
+            
             # Store state in database
-            store_state(session['session_id'], state, file_path)
+            store_state(session['session_id'], state, file_path, db_path=database())
             
             # Get sequence information for display
             sequences = []
@@ -64,11 +153,11 @@ def upload_file():
                     'id': idx,
                     'description': record.description
                 })
-                
-            return render_template('configure.html', 
-                                  sequences=sequences, 
+            
+            return render_template('configure.html',
+                                  sequences=sequences,
                                   filename=filename)
-                                  
+        
         except Exception as e:
             flash(f'Error processing file: {str(e)}')
             return redirect(request.url)
@@ -108,14 +197,67 @@ def validate_formula(formula):
     
     return True, ""
 
-@app.route('/run_scan', methods=['POST'])
+def run_scan_job(session_id, job_id, state, result_key, results_file, summary_file, db_path):
+    """
+    Scan the state and publish its results and group summary, unless a newer
+    scan of the same session has been started in the meantime
+    """
+    try:
+        state = aliscan.scan(state, summary=True)
+        if not is_current_scan(session_id, job_id, db_path=db_path):
+            return
+        aliscan.summary2json(state, summary_file)
+        aliscan.scores2html(state, results_file)
+        # Stores the scanned state only if this job is still the session's latest scan
+        finished, previous_key = finish_scan(session_id, job_id, 'done', result_key=result_key,
+                                             state=state, db_path=db_path)
+        upload_folder = os.path.dirname(results_file)
+        if finished:
+            if previous_key and previous_key != result_key:
+                prune_results(upload_folder, previous_key)
+        else:
+            scan = get_scan(session_id, db_path=db_path)
+            if scan is None or scan['result_key'] != result_key:
+                prune_results(upload_folder, result_key)
+    except Exception as e:
+        finish_scan(session_id, job_id, 'error', str(e), db_path=db_path)
+
+def submit_scan(session_id, state):
+    """
+    Store the configured state and scan it in the background executor,
+    or inline when background scans are disabled.
+    The session's stored results are reused without scanning when the parameters haven't changed.
+    """
+    result_key = aliscan.results_key(state)
+    job_id = start_scan(session_id, str(uuid.uuid4()), db_path=database())
+    
+    if os.path.exists(results_path(result_key)) and os.path.exists(summary_path(result_key)):
+        # The stored scores belong to the previous parameters, drop them
+        state = state.replace(scores=[], summary=None)
+        finished, previous_key = finish_scan(session_id, job_id, 'done', result_key=result_key,
+                                             state=state, db_path=database())
+        if finished and previous_key and previous_key != result_key:
+            prune_results(current_app.config['UPLOAD_FOLDER'], previous_key)
+        return job_id
+    
+    store_state(session_id, state, db_path=database())
+    args = (session_id, job_id, state, result_key, results_path(result_key), summary_path(result_key), database())
+    
+    executor = current_app.extensions['aliscan_executor']
+    if executor is None:
+        run_scan_job(*args)
+    else:
+        executor.submit(run_scan_job, *args)
+    return job_id
+
+@bp.route('/run_scan', methods=['POST'])
 def run_scan():
     # Get state from database
-    state = get_state(session['session_id'])
+    state = get_state(session['session_id'], db_path=database())
     
     if state is None:
         flash('Please upload an alignment file first')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     
     try:
         # Parse groups from form
@@ -141,38 +283,22 @@ def run_scan():
         state = aliscan.set_kb(state, kb)
         
         # Run the scan
-        state = aliscan.scan(state)
-        
-        # Store updated state
-        store_state(session['session_id'], state)
-        
-        # Generate HTML output
-        results_file = os.path.join(app.config['UPLOAD_FOLDER'], f'results_{session["session_id"]}.html')
-        aliscan.scores2html(state, results_file)
-        
-        # Pass the HTML content to the template
-        with open(results_file, 'r') as f:
-            html_content = f.read()
-            
-        return render_template('results.html', 
-                              html_content=html_content,
-                              ka=ka,
-                              kb=kb,
-                              formula=state["scoring_formula"],
-                              groups=groups)
+        submit_scan(session['session_id'], state)
         
+        return redirect(url_for('.results'))
+    
     except Exception as e:
         flash(f'Error running scan: {str(e)}')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
-@app.route('/update_parameters', methods=['POST'])
+@bp.route('/update_parameters', methods=['POST'])
 def update_parameters():
     # Get state from database
-    state = get_state(session['session_id'])
+    state = get_state(session['session_id'], db_path=database())
     
     if state is None:
         flash('Session expired. Please upload a file and configure the analysis again.')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
     
     try:
         # Get updated parameters
@@ -187,10 +313,11 @@ def update_parameters():
             if not is_valid:
                 flash(error_message)
                 # Return the current state with the invalid formula
-                with open(os.path.join(app.config['UPLOAD_FOLDER'], f'results_{session["session_id"]}.html'), 'r') as f:
-                    html_content = f.read()
-                return render_template('results.html', 
+                scan = get_scan(session['session_id'], db_path=database())
+                html_content = read_results(scan['result_key'] if scan else None)
+                return render_template('results.html',
                                       html_content=html_content,
+                                      summary=read_summary(scan['result_key'] if scan else None),
                                       ka=ka,
                                       kb=kb,
                                       formula=new_formula,
@@ -204,41 +331,108 @@ def update_parameters():
         state = aliscan.set_kb(state, kb)
         
         # Re-run the scan
-        state = aliscan.scan(state)
-        
-        # Store updated state
-        store_state(session['session_id'], state)
-        
-        # Generate updated HTML output
-        results_file = os.path.join(app.config['UPLOAD_FOLDER'], f'results_{session["session_id"]}.html')
-        aliscan.scores2html(state, results_file)
-        
-        # Read the updated HTML content
-        with open(results_file, 'r') as f:
-            html_content = f.read()
-        
-        # Keep the original groups for display
-        groups = state["groups"]
-        
-        return render_template('results.html', 
-                              html_content=html_content,
-                              ka=ka,
-                              kb=kb,
-                              formula=state["scoring_formula"],
-                              groups=groups)
+        submit_scan(session['session_id'], state)
         
+        return redirect(url_for('.results'))
+    
     except Exception as e:
         flash(f'Error updating parameters: {str(e)}')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
-@app.route('/download_results')
+@bp.route('/results')
+def results():
+    state = get_state(session['session_id'], db_path=database())
+    scan = get_scan(session['session_id'], db_path=database())
+    
+    if state is None or scan is None:
+        flash('Please upload an alignment file first')
+        return redirect(url_for('.index'))
+    
+    if scan['status'] == 'running':
+        started = datetime.fromisoformat(scan['updated_at'])
+        if (datetime.now() - started).total_seconds() > current_app.config['SCAN_TIMEOUT']:
+            finish_scan(session['session_id'], scan['job_id'], 'error', 'scan timed out', db_path=database())
+            scan = get_scan(session['session_id'], db_path=database())
+    
+    if scan['status'] == 'error':
+        flash(f'Error running scan: {scan["error"]}')
+        return redirect(url_for('.index'))
+    
+    done = scan['status'] == 'done'
+    # Flashed messages make the page differ from the cached one
+    cacheable = done and not session.get('_flashes')
+    if cacheable and request.if_none_match.contains(scan['result_key']):
+        return make_cached_response(make_response('', 304), scan['result_key'])
+    
+    html_content = read_results(scan['result_key']) if done else ''
+    
+    response = make_response(render_template('results.html',
+                                              html_content=html_content,
+                                              summary=read_summary(scan['result_key']) if done else None,
+                                              pending=not done,
+                                              ka=state["ka"],
+                                              kb=state["kb"],
+                                              formula=state["scoring_formula"],
+                                              groups=state["groups"]))
+    if cacheable:
+        make_cached_response(response, scan['result_key'])
+    return response
+
+def make_cached_response(response, etag):
+    """Set the ETag of a per-session response, and require browsers to revalidate it."""
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@bp.route('/download_results')
 def download_results():
-    results_file = os.path.join(app.config['UPLOAD_FOLDER'], f'results_{session["session_id"]}.html')
-    if os.path.exists(results_file):
-        return send_file(results_file, as_attachment=True, download_name="alignment_results.html")
-    else:
+    scan = get_scan(session['session_id'], db_path=database())
+    if scan is None or scan['status'] != 'done' or not os.path.exists(results_path(scan['result_key'])):
         flash('No results file found')
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
+    
+    results_file = results_path(scan['result_key'])
+    if request.accept_encodings['gzip']:
+        # Serve the stored gzip artifact as is
+        response = send_file(results_file, mimetype='text/html', as_attachment=True,
+                             download_name="alignment_results.html",
+                             etag=f'{scan["result_key"]}-gzip', conditional=True)
+        if response.status_code != 304:
+            response.content_encoding = 'gzip'
+    else:
+        with gzip.open(results_file, 'rb') as f:
+            html_content = f.read()
+        response = send_file(io.BytesIO(html_content), mimetype='text/html', as_attachment=True,
+                             download_name="alignment_results.html",
+                             etag=scan['result_key'], conditional=True,
+                             last_modified=os.path.getmtime(results_file))
+    
+    response.vary.add('Accept-Encoding')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@bp.route('/download_summary')
+def download_summary():
+    scan = get_scan(session['session_id'], db_path=database())
+    summary = read_summary(scan['result_key']) if scan and scan['status'] == 'done' else None
+    if summary is None:
+        flash('No summary found')
+        return redirect(url_for('.index'))
+    
+    if request.args.get('format', 'json') == 'csv':
+        response = make_response(aliscan.summary_to_csv(summary))
+        response.mimetype = 'text/csv'
+        download_name = 'alignment_summary.csv'
+    else:
+        response = make_response(aliscan.summary_to_json(summary))
+        response.mimetype = 'application/json'
+        download_name = 'alignment_summary.json'
+    
+    response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    make_cached_response(response, f'{scan["result_key"]}-{download_name}')
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
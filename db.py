@@ -6,11 +6,20 @@ from datetime import datetime
 
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aliscan.db')
 
-def init_db():
+# Seconds a connection waits on a lock held by another process before failing
+DB_TIMEOUT = 30
+
+# Every function takes an optional db_path, defaulting to DB_PATH, so that each
+# application (and the background scans it starts) can use its own database
+
+def init_db(db_path=None):
     """Initialize the database and create necessary tables if they don't exist."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
+    # WAL lets readers in other worker processes proceed while one process writes
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Create sessions table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS sessions (
@@ -22,44 +31,62 @@ def init_db():
     )
     ''')
     
+    # Create scans table, tracking the background scan of each session
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS scans (
+        session_id TEXT PRIMARY KEY,
+        job_id TEXT,
+        status TEXT,
+        error TEXT,
+        result_key TEXT,
+        updated_at TIMESTAMP
+    )
+    ''')
+    
+    # Add the result_key column to scans tables created before it existed
+    cursor.execute("PRAGMA table_info(scans)")
+    if 'result_key' not in [column[1] for column in cursor.fetchall()]:
+        try:
+            cursor.execute("ALTER TABLE scans ADD COLUMN result_key TEXT")
+        except sqlite3.OperationalError:
+            # Another worker process added it in the meantime
+            pass
+    
     conn.commit()
     conn.close()
 
-def get_db_connection():
+def get_db_connection(db_path=None):
     """Get a database connection."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(db_path or DB_PATH, timeout=DB_TIMEOUT)
     conn.row_factory = sqlite3.Row
     return conn
 
-def store_state(session_id, state, alignment_file=None):
+def store_state(session_id, state, alignment_file=None, db_path=None):
     """Store or update state in the database."""
-    conn = get_db_connection()
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
     now = datetime.now().isoformat()
     
-    # Check if session exists
-    cursor.execute("SELECT 1 FROM sessions WHERE session_id = ?", (session_id,))
-    if cursor.fetchone():
-        # Update existing session
-        cursor.execute(
-            "UPDATE sessions SET state_pickle = ?, updated_at = ? WHERE session_id = ?",
-            (pickle.dumps(state), now, session_id)
-        )
-    else:
-        # Create new session
-        cursor.execute(
-            "INSERT INTO sessions (session_id, alignment_file, state_pickle, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
-            (session_id, alignment_file, pickle.dumps(state), now, now)
-        )
+    # Insert or update in a single statement, so that concurrent workers can't race
+    # between checking for the session and creating it
+    cursor.execute(
+        """INSERT INTO sessions (session_id, alignment_file, state_pickle, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(session_id) DO UPDATE SET
+            alignment_file = COALESCE(excluded.alignment_file, alignment_file),
+            state_pickle = excluded.state_pickle,
+            updated_at = excluded.updated_at""",
+        (session_id, alignment_file, pickle.dumps(state), now, now)
+    )
     
     conn.commit()
     conn.close()
     return session_id
 
-def get_state(session_id):
+def get_state(session_id, db_path=None):
     """Retrieve state from the database."""
-    conn = get_db_connection()
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
     cursor.execute("SELECT state_pickle FROM sessions WHERE session_id = ?", (session_id,))
@@ -71,9 +98,9 @@ def get_state(session_id):
         return pickle.loads(row['state_pickle'])
     return None
 
-def get_alignment_file(session_id):
+def get_alignment_file(session_id, db_path=None):
     """Get the alignment file path for a session."""
-    conn = get_db_connection()
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
     cursor.execute("SELECT alignment_file FROM sessions WHERE session_id = ?", (session_id,))
@@ -85,12 +112,113 @@ def get_alignment_file(session_id):
         return row['alignment_file']
     return None
 
-def delete_session(session_id):
+def delete_session(session_id, db_path=None):
     """Delete a session from the database."""
-    conn = get_db_connection()
+    conn = get_db_connection(db_path)
     cursor = conn.cursor()
     
     cursor.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+    cursor.execute("DELETE FROM scans WHERE session_id = ?", (session_id,))
+    
+    conn.commit()
+    conn.close()
+
+def start_scan(session_id, job_id, db_path=None):
+    """
+    Record job_id as the running scan of a session, superseding any previous one.
+    The results key of the previous scan is kept until the new one finishes.
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute(
+        """INSERT INTO scans (session_id, job_id, status, error, updated_at)
+        VALUES (?, ?, 'running', NULL, ?)
+        ON CONFLICT(session_id) DO UPDATE SET
+            job_id = excluded.job_id,
+            status = excluded.status,
+            error = NULL,
+            updated_at = excluded.updated_at""",
+        (session_id, job_id, datetime.now().isoformat())
+    )
     
     conn.commit()
     conn.close()
+    return job_id
+
+def finish_scan(session_id, job_id, status, error=None, result_key=None, state=None, db_path=None):
+    """
+    Set the final status ('done' or 'error') of a scan, the key of its results and,
+    in the same transaction, the scanned state of the session.
+    Returns (finished, previous_result_key): finished is False if job_id has been
+    superseded by a newer scan of the session, in which case nothing is changed.
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    
+    # Take the write lock up front, so no other scan can start until the state is stored
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT result_key FROM scans WHERE session_id = ? AND job_id = ?", (session_id, job_id))
+    row = cursor.fetchone()
+    if row is None:
+        conn.rollback()
+        conn.close()
+        return False, None
+    
+    now = datetime.now().isoformat()
+    cursor.execute(
+        "UPDATE scans SET status = ?, error = ?, result_key = COALESCE(?, result_key), updated_at = ? WHERE session_id = ?",
+        (status, error, result_key, now, session_id)
+    )
+    if state is not None:
+        cursor.execute(
+            "UPDATE sessions SET state_pickle = ?, updated_at = ? WHERE session_id = ?",
+            (pickle.dumps(state), now, session_id)
+        )
+    
+    conn.commit()
+    conn.close()
+    return True, row['result_key']
+
+def delete_scan(session_id, db_path=None):
+    """
+    Forget the scan of a session, so that a running one can't finish and its results
+    are no longer served. Returns the results key of the deleted scan, or None.
+    """
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute("BEGIN IMMEDIATE")
+    cursor.execute("SELECT result_key FROM scans WHERE session_id = ?", (session_id,))
+    row = cursor.fetchone()
+    cursor.execute("DELETE FROM scans WHERE session_id = ?", (session_id,))
+    
+    conn.commit()
+    conn.close()
+    return row['result_key'] if row else None
+
+def is_current_scan(session_id, job_id, db_path=None):
+    """Check whether job_id is still the latest scan of a session."""
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT job_id FROM scans WHERE session_id = ?", (session_id,))
+    row = cursor.fetchone()
+    
+    conn.close()
+    
+    return row is not None and row['job_id'] == job_id
+
+def get_scan(session_id, db_path=None):
+    """Get the latest scan record (job_id, status, error, result_key, updated_at) of a session."""
+    conn = get_db_connection(db_path)
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT job_id, status, error, result_key, updated_at FROM scans WHERE session_id = ?", (session_id,))
+    row = cursor.fetchone()
+    
+    conn.close()
+    
+    if row:
+        return dict(row)
+    return None
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Local load test for the aliscan web interface
+# author email: patrick.demarta@gmail.com
+#
+# Runs concurrent upload -> scan -> update cycles against a running server
+# and reports requests per second and latency percentiles, e.g.:
+#   python loadtest.py --url http://127.0.0.1:8000 --clients 8 --cycles 5
+
+import argparse
+import http.cookiejar
+import os
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+PENDING_MARKER = b'Alignment scan in progress'
+
+def percentile(values, pct):
+    """Return the pct percentile of values (nearest rank)"""
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+def multipart_body(field, filename, content):
+    """Encode a single file upload as a multipart/form-data body"""
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+class Client:
+    """A single user session, with its own cookies"""
+
+    def __init__(self, base_url, latencies, lock):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.latencies = latencies
+        self.lock = lock
+
+    def request(self, name, path, data=None, content_type=None):
+        """Send a request (following redirects), record its latency under name and return the body"""
+        req = urllib.request.Request(self.base_url + path, data=data)
+        if content_type:
+            req.add_header('Content-Type', content_type)
+        start = time.perf_counter()
+        with self.opener.open(req) as response:
+            body = response.read()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+        return body
+
+    def post_form(self, name, path, fields):
+        return self.request(name, path, urllib.parse.urlencode(fields, doseq=True).encode(),
+                            'application/x-www-form-urlencoded')
+
+    def wait_results(self, body, poll_interval):
+        """Poll the results page until the background scan is over"""
+        while PENDING_MARKER in body:
+            time.sleep(poll_interval)
+            body = self.request('results', '/results')
+        return body
+
+    def cycle(self, cycle_index, filename, content, groups, poll_interval):
+        """
+        Run one upload -> scan -> update cycle, with kb varying by cycle_index
+        so that every scan misses the server's results cache
+        """
+        kb = cycle_index % 101
+        start = time.perf_counter()
+        body, content_type = multipart_body('alignment_file', filename, content)
+        self.request('upload', '/upload', body, content_type)
+
+        fields = {'group_count': len(groups), 'ka': 20, 'kb': kb}
+        for group_index, group in enumerate(groups):
+            fields[f'group_{group_index}'] = group
+        self.wait_results(self.post_form('run_scan', '/run_scan', fields), poll_interval)
+
+        fields = {'ka': 10, 'kb': kb, 'formula': '1 - (ka*0.5)*(1-a) - (kb*0.1)*b'}
+        self.wait_results(self.post_form('update_parameters', '/update_parameters', fields), poll_interval)
+
+        with self.lock:
+            self.latencies.setdefault('cycle', []).append(time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a running aliscan server')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='base url of the server')
+    parser.add_argument('--file', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                       'test_alignments', 'simple_test.fasta'),
+                        help='fasta alignment to upload')
+    parser.add_argument('--clients', type=int, default=4, help='number of concurrent sessions')
+    parser.add_argument('--cycles', type=int, default=5, help='upload -> scan -> update cycles per session')
+    parser.add_argument('--poll-interval', type=float, default=0.2, help='seconds between results polls')
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as f:
+        content = f.read()
+    # Split the sequences in two halves
+    num_of_seqs = content.count(b'>')
+    half = max(1, num_of_seqs // 2)
+    groups = [list(range(half)), list(range(half, num_of_seqs))]
+    groups = [group for group in groups if group]
+
+    latencies = {}
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        client = Client(args.url, latencies, lock)
+        for cycle_index in range(args.cycles):
+            try:
+                client.cycle(cycle_index, os.path.basename(args.file), content, groups, args.poll_interval)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+
+    threads = [threading.Thread(target=worker) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    num_of_requests = sum(len(values) for name, values in latencies.items() if name != 'cycle')
+    print(f'{args.clients} clients x {args.cycles} cycles in {elapsed:.2f}s, {len(errors)} errors')
+    print(f'{num_of_requests} requests, {num_of_requests / elapsed:.1f} requests/s')
+    print(f'{"endpoint":<20}{"count":>8}{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}')
+    for name in ('upload', 'run_scan', 'update_parameters', 'results', 'cycle'):
+        values = latencies.get(name)
+        if not values:
+            continue
+        print(f'{name:<20}{len(values):>8}'
+              f'{statistics.mean(values) * 1000:>10.1f}'
+              f'{percentile(values, 50) * 1000:>10.1f}'
+              f'{percentile(values, 90) * 1000:>10.1f}'
+              f'{percentile(values, 99) * 1000:>10.1f}')
+    for error in errors[:10]:
+        print(f'error: {error}')
+
+if __name__ == '__main__':
+    main()
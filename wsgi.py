@@ -0,0 +1,16 @@
+#!/usr/bin/env python3
+# Production WSGI entry point for aliscan
+# author email: patrick.demarta@gmail.com
+#
+# Run with e.g.:
+#   ALISCAN_SECRET_KEY=... gunicorn --workers 4 --bind 0.0.0.0:8000 wsgi:app
+
+import os
+from app import create_app, DEFAULT_SECRET_KEY
+
+# Every worker process must sign sessions with the same key, so it can't be
+# generated per process nor left to the development default
+if os.environ.get('ALISCAN_SECRET_KEY', DEFAULT_SECRET_KEY) == DEFAULT_SECRET_KEY:
+    raise RuntimeError('Set ALISCAN_SECRET_KEY to a private random value to run aliscan in production')
+
+app = create_app()